@@ -1,79 +1,206 @@
+import io
+import threading
 import streamlit as st
 import pandas as pd
 import numpy as np
-import joblib
 import bcrypt
 import sqlite3
-from datetime import datetime
 
 # ---------- DATABASE SETUP ----------
-conn = sqlite3.connect("database/users.db", check_same_thread=False)
-c = conn.cursor()
+DB_PATH = "database/users.db"
 
+@st.cache_resource(show_spinner=False)
+def get_conn(path):
+    # One connection per server process, shared across reruns and sessions.
+    # check_same_thread=False because every session's script thread uses it: writes
+    # must hold DB_LOCK, since transactions on a shared connection are shared too
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456")  # read pages via mmap, up to 256 MB
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def get_db_lock(path):
+    # Serializes write transactions across sessions so one session's commit or
+    # rollback can't take another session's pending statements with it. Cached,
+    # because module-level objects are recreated on every script rerun
+    return threading.Lock()
+
+conn = get_conn(DB_PATH)
+DB_LOCK = get_db_lock(DB_PATH)
+c = conn.cursor()  # write cursor; only use while holding DB_LOCK
+
+@st.cache_resource(show_spinner=False)
 def create_tables():
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE,
-                    password TEXT)''')
+    # Runs once per server process rather than on every rerun
+    with DB_LOCK:
+        c.execute('''CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT UNIQUE,
+                        password BLOB)''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS farmer_profiles (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    name TEXT,
-                    income REAL,
-                    farm_size REAL,
-                    loan_amount REAL,
-                    region TEXT,
-                    prev_defaults INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS farmer_profiles (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        name TEXT,
+                        income REAL,
+                        farm_size REAL,
+                        loan_amount REAL,
+                        region TEXT,
+                        prev_defaults INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS water_quality (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    ph REAL,
-                    temperature REAL,
-                    ammonia REAL,
-                    do_level REAL,
-                    turbidity REAL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS water_quality (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        ph REAL,
+                        temperature REAL,
+                        ammonia REAL,
+                        do_level REAL,
+                        turbidity REAL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
     
-    c.execute('''CREATE TABLE IF NOT EXISTS model_outputs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    risk_score_financial REAL,
-                    risk_score_technical REAL,
-                    risk_label TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
+        c.execute('''CREATE TABLE IF NOT EXISTS model_outputs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER,
+                        risk_score_financial REAL,
+                        risk_score_technical REAL,
+                        risk_label TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_farmer_user_latest
+                     ON farmer_profiles(user_id, id DESC)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_water_user_latest
+                     ON water_quality(user_id, id DESC)''')
+        # Ascending on purpose: a backward scan yields created_at DESC, id DESC (the
+        # implicit rowid is stored ascending), so history paging needs no sort step
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_model_user_time
+                     ON model_outputs(user_id, created_at)''')
+        conn.commit()
 
 create_tables()
 
 # ---------- AUTH ----------
+# Cost factor for new hashes (~4x cheaper than bcrypt's default of 12);
+# existing hashes keep verifying with the rounds they were created with
+BCRYPT_ROUNDS = 10
+
 def hash_password(password):
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
 
 def verify_password(password, hashed):
     return bcrypt.checkpw(password.encode(), hashed)
 
 def register_user(username, password):
     hashed_pw = hash_password(password)
-    try:
-        c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_pw))
-        conn.commit()
-        return True
-    except:
-        return False
+    with DB_LOCK:
+        with conn:
+            c.execute("INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)", (username, hashed_pw))
+        return c.rowcount == 1  # 0 when the username is already taken
 
 def login_user(username, password):
-    c.execute("SELECT id, password FROM users WHERE username=?", (username,))
-    data = c.fetchone()
+    data = conn.execute("SELECT id, password FROM users WHERE username=? LIMIT 1", (username,)).fetchone()
     if data and verify_password(password, data[1]):
         return data[0]  # return user_id
     return None
 
+# ---------- RESULTS ----------
+OUTPUT_COLS = ("user_id", "risk_score_financial", "risk_score_technical", "risk_label")
+INSERT_OUTPUT_SQL = (f"INSERT INTO model_outputs ({', '.join(OUTPUT_COLS)}) "
+                     f"VALUES ({', '.join('?' * len(OUTPUT_COLS))})")
+
+def save_results(rows):
+    # rows: iterable of tuples ordered as OUTPUT_COLS, written in one transaction
+    with DB_LOCK, conn:
+        c.executemany(INSERT_OUTPUT_SQL, rows)
+
+def save_result(user_id, risk_score_fin, risk_score_tech, risk_label):
+    save_results([(user_id, float(risk_score_fin), float(risk_score_tech), risk_label)])
+
+HISTORY_LIMIT = 200  # largest page the History tab will request
+
+def latest_output_id(user_id):
+    # Single index lookup; used as a per-user cache key so new results show up
+    # without clearing every other user's cached history
+    row = conn.execute('''SELECT id FROM model_outputs WHERE user_id=?
+                          ORDER BY created_at DESC, id DESC LIMIT 1''', (user_id,)).fetchone()
+    return row[0] if row else None
+
+@st.cache_data(ttl=30, show_spinner=False)
+def load_history(user_id, limit=HISTORY_LIMIT, offset=0, latest_id=None):
+    # id breaks created_at ties so pages don't overlap; idx_model_user_time read
+    # backwards already returns rows in this order
+    cur = conn.execute('''SELECT created_at, risk_score_financial, risk_score_technical, risk_label
+                          FROM model_outputs WHERE user_id=? ORDER BY created_at DESC, id DESC
+                          LIMIT ? OFFSET ?''',
+                       (user_id, min(limit, HISTORY_LIMIT), offset))
+    return pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+
+# ---------- UPLOADS ----------
+# Numeric columns skip type inference but keep full float64 precision, since the
+# parsed values are what gets stored; score_batch narrows to float32 for the models
+LOAN_DTYPES = {"income": "float64", "farm_size": "float64", "loan_amount": "float64", "prev_defaults": "float64"}
+WATER_DTYPES = {"ph": "float64", "temperature": "float64", "ammonia": "float64",
+                "do_level": "float64", "turbidity": "float64"}
+
+INSERT_FARMER_SQL = '''INSERT INTO farmer_profiles (user_id, name, income, farm_size, loan_amount, region, prev_defaults)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)'''
+INSERT_WATER_SQL = '''INSERT INTO water_quality (user_id, ph, temperature, ammonia, do_level, turbidity)
+                      VALUES (?, ?, ?, ?, ?, ?)'''
+
+@st.cache_data(show_spinner=False)
+def read_csv(data, name, dtype=None):
+    # Keyed on the uploaded bytes so reruns with the same file skip parsing
+    return pd.read_csv(io.BytesIO(data), dtype=dtype)
+
 # ---------- MODELS ----------
-loan_model = joblib.load('ml_models/loan_model.pkl')
-failure_model = joblib.load('ml_models/failure_model.pkl')
+# Column order must match the order the models were trained on
+LOAN_FEATURES = ("income", "farm_size", "loan_amount", "prev_defaults")
+WATER_FEATURES = ("ph", "temperature", "ammonia", "do_level", "turbidity")
+
+@st.cache_resource
+def get_models():
+    # joblib (and sklearn, pulled in by unpickling) is only imported once a user logs in
+    import joblib
+    # Unpickled once per server process, on first use after login. The pickles are
+    # uncompressed so estimators that keep plain ndarray nodes (e.g. HistGradientBoosting)
+    # can be memory-mapped; forest trees copy their nodes on load, so mmap shares nothing there
+    models = (joblib.load('ml_models/loan_model.pkl', mmap_mode='r'),
+              joblib.load('ml_models/failure_model.pkl', mmap_mode='r'))
+    for model in models:
+        # None resolves to a single job unless score_batch opts into parallelism
+        if hasattr(model, "n_jobs"):
+            model.n_jobs = None
+    return models
+
+# Below this many rows, thread start-up costs more than parallel tree walks save
+PARALLEL_MIN_ROWS = 1000
+
+def score_batch(model, rows):
+    # One predict_proba call for any number of rows; returns the positive-class scores
+    # C-contiguous float32 is what forest trees read, so for the failure forest this
+    # is the only conversion. HistGradientBoosting (the loan model) upcasts to
+    # float64 and copies once more; float32 is kept there to match its training data
+    X = np.ascontiguousarray(rows, dtype=np.float32)
+    if len(X) < PARALLEL_MIN_ROWS:
+        return model.predict_proba(X)[:, 1]
+    # parallel_config is thread-local, so other sessions sharing the model are unaffected
+    from joblib import parallel_config
+    with parallel_config(n_jobs=-1):
+        return model.predict_proba(X)[:, 1]
+
+@st.cache_data(show_spinner=False)
+def score_upload(data, name, dtype, features, _model):
+    # Scores are cached on the upload bytes (and feature set, which tells the two
+    # models apart), so reruns don't re-score; the model itself is not hashed
+    df = read_csv(data, name, dtype)
+    if df.empty:
+        return None
+    return score_batch(_model, df[list(features)])
 
 # ---------- APP ----------
 st.set_page_config(page_title="Aqua Risk Assessment", layout="wide")
@@ -84,6 +211,10 @@ choice = st.sidebar.selectbox("Menu", menu)
 
 if 'user_id' not in st.session_state:
     st.session_state.user_id = None
+if 'ingested_files' not in st.session_state:
+    st.session_state.ingested_files = set()
+if 'saved_assessments' not in st.session_state:
+    st.session_state.saved_assessments = set()
 
 if choice == "Register":
     st.subheader("Create Account")
@@ -97,70 +228,120 @@ if choice == "Register":
 
 elif choice == "Login":
     st.subheader("Login to Your Account")
-    username = st.text_input("Username")
-    password = st.text_input("Password", type="password")
-    if st.button("Login"):
-        user_id = login_user(username, password)
-        if user_id:
-            st.success(f"Welcome, {username}!")
-            st.session_state.user_id = user_id
-        else:
-            st.error("Invalid credentials")
+    if st.session_state.user_id:
+        # Already verified this session; don't run bcrypt again
+        st.info("You are logged in.")
+        if st.button("Logout"):
+            st.session_state.user_id = None
+            st.session_state.ingested_files = set()
+            st.session_state.saved_assessments = set()
+            # Re-render now so this run doesn't finish in the logged-in state
+            st.rerun()
+    else:
+        username = st.text_input("Username")
+        password = st.text_input("Password", type="password")
+        if st.button("Login"):
+            user_id = login_user(username, password)
+            if user_id:
+                st.success(f"Welcome, {username}!")
+                st.session_state.user_id = user_id
+            else:
+                st.error("Invalid credentials")
 
 # ---------- MAIN APP AFTER LOGIN ----------
+@st.fragment
+def history_panel(user_id):
+    # Paging reruns only this fragment, not the uploads and predictions above it
+    col1, col2 = st.columns(2)
+    page_size = col1.number_input("Rows per page", min_value=10, max_value=HISTORY_LIMIT, value=50, step=10)
+    page = col2.number_input("Page", min_value=1, value=1, step=1)
+    df = load_history(user_id, int(page_size), int((page - 1) * page_size), latest_output_id(user_id))
+    st.dataframe(df)
+
 if st.session_state.user_id:
+    loan_model, failure_model = get_models()
+
     tab1, tab2, tab3, tab4 = st.tabs(["📤 Upload Data", "🔍 Predict Risk", "📈 View History", "ℹ️ About"])
 
     with tab1:
         st.header("Upload Farmer Loan Data")
         loan_file = st.file_uploader("Upload CSV for Loan Data", type=["csv"], key="loan")
+        df_loan = None
         if loan_file:
-            df_loan = pd.read_csv(loan_file)
-            st.dataframe(df_loan)
-
-            for _, row in df_loan.iterrows():
-                c.execute('''INSERT INTO farmer_profiles (user_id, name, income, farm_size, loan_amount, region, prev_defaults)
-                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                          (st.session_state.user_id, row['name'], row['income'], row['farm_size'],
-                           row['loan_amount'], row['region'], row['prev_defaults']))
-            conn.commit()
+            try:
+                df_loan = read_csv(loan_file.getvalue(), loan_file.name, LOAN_DTYPES)
+            except ValueError as e:
+                # Malformed cells (e.g. "1,200" in a numeric column) fail the dtype parse
+                st.error(f"Could not parse {loan_file.name}: {e}")
+        if df_loan is not None:
+            # The uploader keeps the file across reruns; insert each upload only once
+            upload_key = (st.session_state.user_id, loan_file.file_id)
+            if upload_key not in st.session_state.ingested_files:
+                rows = zip([st.session_state.user_id] * len(df_loan), df_loan['name'], df_loan['income'],
+                           df_loan['farm_size'], df_loan['loan_amount'], df_loan['region'], df_loan['prev_defaults'])
+                with DB_LOCK, conn:
+                    c.executemany(INSERT_FARMER_SQL, rows)
+                st.session_state.ingested_files.add(upload_key)
             st.success("Loan data uploaded successfully.")
 
+            # Score every uploaded row in one call; scoring problems never block ingestion
+            try:
+                scores = score_upload(loan_file.getvalue(), loan_file.name, LOAN_DTYPES, LOAN_FEATURES, loan_model)
+            except ValueError as e:
+                scores = None
+                st.warning(f"Could not score uploaded rows: {e}")
+            if scores is not None:
+                df_loan["risk_score_financial"] = scores
+            st.dataframe(df_loan)
+
         st.header("Upload Water Quality Data")
         water_file = st.file_uploader("Upload CSV for Water Data", type=["csv"], key="water")
+        df_water = None
         if water_file:
-            df_water = pd.read_csv(water_file)
-            st.dataframe(df_water)
-
-            for _, row in df_water.iterrows():
-                c.execute('''INSERT INTO water_quality (user_id, ph, temperature, ammonia, do_level, turbidity)
-                             VALUES (?, ?, ?, ?, ?, ?)''',
-                          (st.session_state.user_id, row['ph'], row['temperature'], row['ammonia'],
-                           row['do_level'], row['turbidity']))
-            conn.commit()
+            try:
+                df_water = read_csv(water_file.getvalue(), water_file.name, WATER_DTYPES)
+            except ValueError as e:
+                st.error(f"Could not parse {water_file.name}: {e}")
+        if df_water is not None:
+            upload_key = (st.session_state.user_id, water_file.file_id)
+            if upload_key not in st.session_state.ingested_files:
+                rows = zip([st.session_state.user_id] * len(df_water), df_water['ph'], df_water['temperature'],
+                           df_water['ammonia'], df_water['do_level'], df_water['turbidity'])
+                with DB_LOCK, conn:
+                    c.executemany(INSERT_WATER_SQL, rows)
+                st.session_state.ingested_files.add(upload_key)
             st.success("Water data uploaded successfully.")
 
+            try:
+                scores = score_upload(water_file.getvalue(), water_file.name, WATER_DTYPES, WATER_FEATURES, failure_model)
+            except ValueError as e:
+                scores = None
+                st.warning(f"Could not score uploaded rows: {e}")
+            if scores is not None:
+                df_water["risk_score_technical"] = scores
+            st.dataframe(df_water)
+
     with tab2:
         st.header("Run Risk Predictions")
 
         st.subheader("Latest Farmer Profile")
-        c.execute('''SELECT income, farm_size, loan_amount, prev_defaults 
-                     FROM farmer_profiles WHERE user_id=? ORDER BY id DESC LIMIT 1''', (st.session_state.user_id,))
-        row = c.fetchone()
+        row = conn.execute(f'''SELECT id, {", ".join(LOAN_FEATURES)}
+                               FROM farmer_profiles WHERE user_id=? ORDER BY id DESC LIMIT 1''',
+                           (st.session_state.user_id,)).fetchone()
         if row:
-            input_financial = np.array(row).reshape(1, -1)
-            risk_score_fin = loan_model.predict_proba(input_financial)[0][1]
+            farmer_id = row[0]
+            risk_score_fin = score_batch(loan_model, [row[1:]])[0]
         else:
             risk_score_fin = None
             st.warning("No loan data found.")
 
         st.subheader("Latest Water Quality")
-        c.execute('''SELECT ph, temperature, ammonia, do_level, turbidity
-                     FROM water_quality WHERE user_id=? ORDER BY id DESC LIMIT 1''', (st.session_state.user_id,))
-        row = c.fetchone()
+        row = conn.execute(f'''SELECT id, {", ".join(WATER_FEATURES)}
+                               FROM water_quality WHERE user_id=? ORDER BY id DESC LIMIT 1''',
+                           (st.session_state.user_id,)).fetchone()
         if row:
-            input_tech = np.array(row).reshape(1, -1)
-            risk_score_tech = failure_model.predict_proba(input_tech)[0][1]
+            water_id = row[0]
+            risk_score_tech = score_batch(failure_model, [row[1:]])[0]
         else:
             risk_score_tech = None
             st.warning("No water data found.")
@@ -171,18 +352,17 @@ if st.session_state.user_id:
             risk_label = "High" if risk_score_fin > 0.6 or risk_score_tech > 0.6 else "Medium" if risk_score_fin > 0.4 else "Low"
             st.success(f"Overall Risk Assessment: **{risk_label}**")
 
-            c.execute('''INSERT INTO model_outputs (user_id, risk_score_financial, risk_score_technical, risk_label)
-                         VALUES (?, ?, ?, ?)''',
-                      (st.session_state.user_id, risk_score_fin, risk_score_tech, risk_label))
-            conn.commit()
+            # Reruns re-render this tab; record each farmer/water pairing only once
+            assessment_key = (st.session_state.user_id, farmer_id, water_id)
+            if assessment_key not in st.session_state.saved_assessments:
+                save_result(st.session_state.user_id, risk_score_fin, risk_score_tech, risk_label)
+                st.session_state.saved_assessments.add(assessment_key)
         else:
             st.info("Upload both loan and water data to generate prediction.")
 
     with tab3:
         st.header("Historical Predictions")
-        df = pd.read_sql_query('''SELECT * FROM model_outputs WHERE user_id=? ORDER BY created_at DESC''', conn,
-                               params=(st.session_state.user_id,))
-        st.dataframe(df)
+        history_panel(st.session_state.user_id)
 
     with tab4:
         st.markdown("""
@@ -1,6 +1,7 @@
 # train_loan_model.py
+import numpy as np
 import pandas as pd
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 import joblib
 
 # Load sample loan data
@@ -9,12 +10,19 @@ df = pd.read_csv('data/sample_loan_data.csv')
 # Add a simulated target column (1 = high risk, 0 = low risk)
 df['risk'] = [0, 1, 0]
 
-X = df[['income', 'farm_size', 'loan_amount', 'prev_defaults']]
-y = df['risk']
+# Train on the same float32 values the app scores with; HistGradientBoosting
+# upcasts to float64 internally, so this is for consistency, not speed
+X = df[['income', 'farm_size', 'loan_amount', 'prev_defaults']].to_numpy(dtype=np.float32)
+y = df['risk'].to_numpy(dtype=np.int8)
 
-model = RandomForestClassifier(n_estimators=100, random_state=42)
+# Histogram boosting: one binning pass to train, few shallow trees to predict.
+# min_samples_leaf must be small enough to split the tiny sample set; at the
+# default of 20 every tree is a single leaf and the model predicts the class prior
+model = HistGradientBoostingClassifier(max_iter=100, max_depth=6, learning_rate=0.1,
+                                       min_samples_leaf=1, random_state=42)
 model.fit(X, y)
 
 # Save model
-joblib.dump(model, 'ml_models/loan_model.pkl')
+# Uncompressed so the app can memory-map it
+joblib.dump(model, 'ml_models/loan_model.pkl', compress=0)
 print("✅ Loan model trained and saved.")